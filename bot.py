@@ -1,21 +1,58 @@
-import os
-from dotenv import load_dotenv
+import asyncio
+import re
+import time
+from io import BytesIO
+from urllib.parse import urlparse
+import orjson
 from telegram import (
     Update, InlineKeyboardButton, InlineKeyboardMarkup
 )
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, filters, ContextTypes, ConversationHandler
+    ApplicationBuilder, ApplicationHandlerStop, CommandHandler,
+    CallbackQueryHandler, MessageHandler, PicklePersistence, TypeHandler,
+    filters, ContextTypes, ConversationHandler
 )
+from telegram.request import HTTPXRequest
+import linkedin_api
 from linkedin_api import post_to_linkedin
-from gemini_ai import generate_post
+from gemini_ai import generate_posts, stream_post, warm_up
+from utils.config import CFG
+from utils.image import shrink_image
 from utils.logger import setup_logger
+from utils.state import STATE_TTL, create_store
 
-load_dotenv()
 logger = setup_logger("Bot")
 
-TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-AUTHORIZED_USER_ID = int(os.getenv("AUTHORIZED_USER_ID"))
+TELEGRAM_TOKEN = CFG.telegram_token
+AUTHORIZED_USER_ID = CFG.authorized_user_id
+BOT_STATE_FILE = CFG.bot_state_file
+WEBHOOK_URL = CFG.webhook_url
+WEBHOOK_PORT = CFG.webhook_port
+WEBHOOK_SECRET = CFG.webhook_secret
+# Telegram throttles message edits, so don't update the draft more often than this
+STREAM_EDIT_INTERVAL = 1.5
+MAX_MESSAGE_LENGTH = MessageLimit.MAX_TEXT_LENGTH
+
+TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+START_POST_PATTERN = re.compile(r"^start_post$")
+IMAGE_CHOICE_PATTERN = re.compile(r"^(wait_image|skip_image)$")
+
+# The bot only reacts to messages and inline button presses
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+class OrjsonHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson."""
+
+    @staticmethod
+    def parse_json_payload(payload):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # orjson rejects lone surrogates that anyone can send in a message;
+            # the stock parser replaces them, so such an update can't stall polling
+            return HTTPXRequest.parse_json_payload(payload)
 
 (
     WAIT_TOPIC,
@@ -24,77 +61,212 @@ AUTHORIZED_USER_ID = int(os.getenv("AUTHORIZED_USER_ID"))
     WAIT_FINAL_APPROVAL,
 ) = range(4)
 
-user_data = {}
+# Keyboards are static, so build them once instead of per handler call
+START_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("📝 Post", callback_data="start_post")]])
+IMAGE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📎 Upload Image", callback_data="wait_image"),
+     InlineKeyboardButton("⏭️ Skip", callback_data="skip_image")]
+])
+PREVIEW_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Edit", callback_data="edit_post"),
+     InlineKeyboardButton("🔄 Regenerate", callback_data="regenerate_post")],
+    [InlineKeyboardButton("✅ Approve & Post", callback_data="approve_post")]
+])
+
+# Created in main() once the application (and its user_data) exists
+store = None
+
+async def post_init(application):
+    try:
+        await warm_up()
+    except Exception as e:
+        logger.warning(f"⚠️ Could not pre-warm Gemini client: {e}")
+
+async def post_shutdown(application):
+    await linkedin_api.close()
+
+async def auth_gate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs in group -1 before every other handler; unauthorized updates stop here
+    user = update.effective_user
+    if user and user.id == AUTHORIZED_USER_ID:
+        return
+    if update.callback_query:
+        await update.callback_query.answer("⛔ Access denied.")
+    elif update.effective_message:
+        await update.effective_message.reply_text("⛔ Access denied.")
+    raise ApplicationHandlerStop
+
+async def expire_states(context: ContextTypes.DEFAULT_TYPE):
+    await store.expire()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id != AUTHORIZED_USER_ID:
-        await update.message.reply_text("⛔ Access denied.")
+    await update.message.reply_text("👋 Welcome! Choose an option:", reply_markup=START_KEYBOARD)
+
+async def batch_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Topics are separated by ";", e.g. /batchpost AI in healthcare; remote work
+    _, _, args = update.message.text.partition(" ")
+    topics = [topic.strip() for topic in args.split(";") if topic.strip()]
+    if not topics:
+        await update.message.reply_text("Usage: /batchpost topic one; topic two; ...")
         return
-    keyboard = [[InlineKeyboardButton("📝 Post", callback_data="start_post")]]
-    await update.message.reply_text("👋 Welcome! Choose an option:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text(f"💡 Generating {len(topics)} posts using AI...")
+    try:
+        posts = await generate_posts(topics)
+    except Exception as e:
+        logger.error(f"❌ Error generating batch posts: {e}", exc_info=True)
+        await update.message.reply_text("⚠️ Couldn't generate the posts, try again.")
+        return
+    for topic, text in zip(topics, posts):
+        if text:
+            await update.message.reply_text(f"📝 {topic}\n\n{text}"[:MAX_MESSAGE_LENGTH])
+        else:
+            await update.message.reply_text(f"⚠️ {topic}\n\nCouldn't generate this post.")
+
+async def draft_expired(update: Update):
+    # The store can expire a draft while the persisted conversation is still open
+    await update.effective_message.reply_text("⌛ This draft has expired, please start a new post.")
+    await store.clear(update.effective_user.id)
+    return ConversationHandler.END
+
+async def on_start_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text("🧠 What topic should the LinkedIn post be about?")
+    return WAIT_TOPIC
+
+async def on_wait_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text("📤 OK, send the image now.")
+    return WAIT_IMAGE
+
+async def on_skip_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await show_preview(update, context)
+
+async def on_approve_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    state = await store.get(user_id)
+    text = state.get("text")
+    if not text:
+        return await draft_expired(update)
+    image_id = state.get("image_id")
+
+    try:
+        image_bytes = None
+        if image_id:
+            # Pull the photo from Telegram into memory only when it is actually posted
+            file = await context.bot.get_file(image_id)
+            buf = BytesIO()
+            await file.download_to_memory(out=buf)
+            # Resizing is CPU-bound, keep it off the event loop
+            image_bytes = await asyncio.to_thread(shrink_image, buf.getvalue())
+        status_code, resp = await post_to_linkedin(text, image_bytes, f"{user_id}.jpg")
+        # Consider both 200 (OK) and 202 (Accepted) as success status codes
+        if status_code in (200, 201, 202):
+            await query.message.reply_text("✅ Post submitted successfully! It may take a few moments to appear on LinkedIn.")
+        else:
+            await query.message.reply_text(f"❌ Failed to post. Status: {status_code}, Response: {resp}")
+    except Exception as e:
+        logger.error(f"❌ Error posting to LinkedIn: {e}", exc_info=True)
+        await query.message.reply_text(f"❌ An error occurred while posting: {str(e)}")
+
+    await store.clear(user_id)
+    return ConversationHandler.END
+
+async def on_regenerate_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Cached drafts are reused for repeated topics; this asks Gemini for a fresh one
+    # and replaces the cached copy, so the rejected post is not served again
+    user_id = update.effective_user.id
+    state = await store.get(user_id)
+    topic = state.get("topic")
+    if not topic:
+        return await draft_expired(update)
+    ai_text = await stream_draft(
+        update.callback_query.message, topic,
+        "⚠️ Couldn't regenerate the post, the previous draft is kept.", refresh=True
+    )
+    if ai_text is None:
+        return WAIT_EDIT_DECISION
+    await store.update(user_id, text=ai_text)
+    return await show_preview(update, context)
+
+async def on_edit_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.message.reply_text("✏️ Send the new edited content:")
+    return WAIT_FINAL_APPROVAL
+
+# callback_data -> handler, one lookup per button press
+BUTTON_HANDLERS = {
+    "start_post": on_start_post,
+    "wait_image": on_wait_image,
+    "skip_image": on_skip_image,
+    "approve_post": on_approve_post,
+    "edit_post": on_edit_post,
+    "regenerate_post": on_regenerate_post,
+}
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
-    if update.effective_user.id != AUTHORIZED_USER_ID:
-        await query.message.reply_text("⛔ Access denied.")
-        return
+    handler = BUTTON_HANDLERS.get(query.data)
+    if handler:
+        return await handler(update, context)
 
-    if query.data == "start_post":
-        await query.message.reply_text("🧠 What topic should the LinkedIn post be about?")
-        return WAIT_TOPIC
-
-    if query.data == "wait_image":
-        await query.message.reply_text("📤 OK, send the image now.")
-        return WAIT_IMAGE
+async def still_working(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # A press while a non-blocking step (upload, generation) is still running
+    await update.callback_query.answer("⏳ Still working…")
 
-    if query.data == "skip_image":
-        return await show_preview(update, context)
+async def stale_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Buttons on an old preview after the conversation ended; answer so the client stops spinning
+    await update.callback_query.answer("This draft has expired.")
 
-    if query.data == "approve_post":
-        user_id = update.effective_user.id
-        text = user_data[user_id]["text"]
-        image = user_data[user_id].get("image")
-        
-        try:
-            status_code, resp = post_to_linkedin(text, image)
-            # Consider both 200 (OK) and 202 (Accepted) as success status codes
-            if status_code in (200, 201, 202):
-                await query.message.reply_text("✅ Post submitted successfully! It may take a few moments to appear on LinkedIn.")
-            else:
-                await query.message.reply_text(f"❌ Failed to post. Status: {status_code}, Response: {resp}")
-        except Exception as e:
-            await query.message.reply_text(f"❌ An error occurred while posting: {str(e)}")
-            
-        user_data.pop(user_id, None)
-        return ConversationHandler.END
-
-    if query.data == "edit_post":
-        await query.message.reply_text("✏️ Send the new edited content:")
-        return WAIT_FINAL_APPROVAL
+async def stream_draft(message, topic, error_text, refresh=False):
+    """Stream a post into a placeholder message; return None if generation fails."""
+    draft = await message.reply_text("💡 Generating content using AI...")
+    ai_text = ""
+    shown_text = ""
+    last_edit = time.monotonic()
+    try:
+        async for chunk in stream_post(topic, refresh=refresh):
+            # Telegram rejects longer messages, so the draft is capped to one
+            ai_text = (ai_text + chunk)[:MAX_MESSAGE_LENGTH]
+            if ai_text != shown_text and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+                try:
+                    await draft.edit_text(ai_text)
+                    shown_text = ai_text
+                except RetryAfter:
+                    # Rate limited: drop this intermediate edit, the next one catches up
+                    pass
+                last_edit = time.monotonic()
+        if not ai_text:
+            raise ValueError("Gemini returned an empty post")
+        if ai_text != shown_text:
+            try:
+                await draft.edit_text(ai_text)
+            except RetryAfter as e:
+                # The last edit must land, otherwise the draft is lost
+                await asyncio.sleep(e.retry_after)
+                await draft.edit_text(ai_text)
+    except Exception as e:
+        logger.error(f"❌ Error generating post: {e}", exc_info=True)
+        await draft.edit_text(error_text)
+        return None
+    return ai_text
 
 async def receive_topic(update: Update, context: ContextTypes.DEFAULT_TYPE):
     topic = update.message.text
-    await update.message.reply_text("💡 Generating content using AI...")
-    ai_text = generate_post(topic)
-    user_data[update.effective_user.id] = {"text": ai_text}
-
-    keyboard = [
-        [InlineKeyboardButton("📎 Upload Image", callback_data="wait_image"),
-         InlineKeyboardButton("⏭️ Skip", callback_data="skip_image")]
-    ]
-    await update.message.reply_text("Do you want to add an image?", reply_markup=InlineKeyboardMarkup(keyboard))
+    ai_text = await stream_draft(
+        update.message, topic, "⚠️ Couldn't generate the post, send the topic again."
+    )
+    if ai_text is None:
+        return WAIT_TOPIC
+    await store.set(update.effective_user.id, text=ai_text, topic=topic)
+
+    await update.message.reply_text("Do you want to add an image?", reply_markup=IMAGE_KEYBOARD)
     return WAIT_IMAGE
 
 async def receive_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
         photo = update.message.photo[-1]  # Highest resolution
-        file = await photo.get_file()
-        file_path = f"/tmp/{user_id}.jpg"
-        await file.download_to_drive(file_path)
-        user_data[user_id]["image"] = file_path
+        await store.update(user_id, image_id=photo.file_id)
         await update.message.reply_text("🖼️ Image received.")
         return await show_preview(update, context)
     except Exception as e:
@@ -104,19 +276,17 @@ async def receive_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_preview(update_or_query, context):
     user_id = update_or_query.effective_user.id
-    text = user_data[user_id]["text"]
-    image = user_data[user_id].get("image")
-
-    keyboard = [
-        [InlineKeyboardButton("✏️ Edit", callback_data="edit_post"),
-         InlineKeyboardButton("✅ Approve & Post", callback_data="approve_post")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    state = await store.get(user_id)
+    text = state.get("text")
+    if not text:
+        return await draft_expired(update_or_query)
+    image_id = state.get("image_id")
+    reply_markup = PREVIEW_KEYBOARD
 
     try:
-        if image and os.path.exists(image):
-            with open(image, "rb") as img:
-                await context.bot.send_photo(chat_id=user_id, photo=img)
+        # Re-send by file_id: Telegram serves the photo, no disk read in the event loop
+        if image_id:
+            await context.bot.send_photo(chat_id=user_id, photo=image_id)
 
         if hasattr(update_or_query, 'callback_query') and update_or_query.callback_query:
             await update_or_query.callback_query.message.reply_text(text, reply_markup=reply_markup)
@@ -132,38 +302,84 @@ async def show_preview(update_or_query, context):
     return WAIT_EDIT_DECISION
 
 async def receive_edited(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_data[update.effective_user.id]["text"] = update.message.text
+    await store.update(update.effective_user.id, text=update.message.text)
     return await show_preview(update, context)
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Cancelled.")
-    user_data.pop(update.effective_user.id, None)
+    await store.clear(update.effective_user.id)
     return ConversationHandler.END
 
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    CFG.require("telegram_token", "authorized_user_id", "gemini_api_key")
+
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        logger.info("uvloop not available, using the default event loop.")
+
+    # One multiplexed HTTP/2 pool for all outbound calls to api.telegram.org
+    request = OrjsonHTTPXRequest(http_version="2", connection_pool_size=100)
+    # getUpdates gets its own request object; decode incoming updates with orjson too
+    get_updates_request = OrjsonHTTPXRequest(http_version="2")
+    # Conversation states and user_data survive restarts
+    persistence = PicklePersistence(filepath=BOT_STATE_FILE)
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .persistence(persistence)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    global store
+    store = create_store(app)
 
     conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(button_handler, pattern="^start_post$")],
+        entry_points=[CallbackQueryHandler(button_handler, pattern=START_POST_PATTERN)],
         states={
-            WAIT_TOPIC: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_topic)],
+            # Slow handlers (Gemini, LinkedIn upload) run as tasks so other updates aren't queued behind them
+            WAIT_TOPIC: [MessageHandler(TEXT_FILTER, receive_topic, block=False)],
             WAIT_IMAGE: [
-                CallbackQueryHandler(button_handler, pattern="^wait_image$"),
-                CallbackQueryHandler(button_handler, pattern="^skip_image$"),
+                CallbackQueryHandler(button_handler, pattern=IMAGE_CHOICE_PATTERN),
                 MessageHandler(filters.PHOTO, receive_image)
             ],
-            WAIT_EDIT_DECISION: [CallbackQueryHandler(button_handler)],
-            WAIT_FINAL_APPROVAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_edited)],
+            WAIT_EDIT_DECISION: [CallbackQueryHandler(button_handler, block=False)],
+            WAIT_FINAL_APPROVAL: [MessageHandler(TEXT_FILTER, receive_edited)],
+            ConversationHandler.WAITING: [CallbackQueryHandler(still_working)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="post_flow",
+        persistent=True,
+        # Abandoned flows end together with their stored draft
+        conversation_timeout=STATE_TTL,
     )
 
+    app.job_queue.run_repeating(expire_states, interval=300)
+
+    app.add_handler(TypeHandler(Update, auth_gate), group=-1)
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("batchpost", batch_post, block=False))
     app.add_handler(conv_handler)
-    app.add_handler(CallbackQueryHandler(button_handler))
+    app.add_handler(CallbackQueryHandler(stale_button))
 
-    logger.info("Bot running.")
-    app.run_polling()
+    if WEBHOOK_URL:
+        logger.info("Bot running (webhook).")
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=WEBHOOK_PORT,
+            # Serve on the same path Telegram is told to call
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        logger.info("Bot running.")
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
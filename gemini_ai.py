@@ -1,14 +1,381 @@
-from google import genai
-import os
-from dotenv import load_dotenv
+import asyncio
+import diskcache
+import functools
+import hashlib
+import httpx
+import json
+import logging
+import string
+import time
+from types import SimpleNamespace
+from tenacity import (
+    before_sleep_log, retry, retry_if_exception, stop_after_attempt,
+    wait_random_exponential
+)
+from utils.config import CFG
+from utils.logger import setup_logger
 
-load_dotenv()
+logger = setup_logger("Gemini")
 
-# The client gets the API key from the environment variable `GEMINI_API_KEY`.
-client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
-def generate_post(content):
-    response = client.models.generate_content(
-        model="gemini-2.5-flash", contents=content+" also remove all *symbols in the artcile and in the sub headings plzamek it for linkedin and dont tell heres ur likethat only give the article "
+MODEL = "gemini-2.5-flash"
+SYSTEM_PROMPT = "Expert LinkedIn copywriter."
+PROMPT_TEMPLATE = string.Template(
+    'Write a LinkedIn post about "$topic". Plain text only, no * or markdown '
+    "symbols in the body or headings. Reply with the post only."
+)
+BATCH_PROMPT_TEMPLATE = string.Template(
+    "Write one LinkedIn post for each topic in this JSON array: $topics. "
+    "Plain text only, no * or markdown symbols in the body or headings. "
+    "Return a JSON array of the posts in the same order as the topics."
+)
+TEMPERATURE = CFG.gemini_temperature
+CACHE_DIR = CFG.gemini_cache_dir
+CACHE_TTL = CFG.gemini_cache_ttl
+CACHE_ENABLED = CFG.gemini_cache_enabled
+# Opt-in: reuse a cached post for a topic whose embedding is close enough
+SEMANTIC_CACHE_ENABLED = CFG.gemini_semantic_cache
+SEMANTIC_THRESHOLD = CFG.gemini_semantic_threshold
+SEMANTIC_INDEX_SIZE = 1000
+EMBEDDING_MODEL = "text-embedding-004"
+MAX_CONCURRENCY = CFG.gemini_max_concurrency
+MAX_REQUESTS_PER_MINUTE = CFG.gemini_max_rpm
+MAX_TOKENS_PER_MINUTE = CFG.gemini_max_tpm
+# Rough Gemini ratio; good enough for budgeting without a tokenizer round trip
+CHARS_PER_TOKEN = 4
+MAX_TOPIC_TOKENS = 300
+
+
+class RateLimiter:
+    """Leaky-bucket throttle for requests/minute and tokens/minute."""
+
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.requests_remaining = max_requests_per_minute
+        self.tokens_remaining = max_tokens_per_minute
+        self._last_update = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_update
+        self._last_update = now
+        self.requests_remaining = min(
+            self.max_requests_per_minute,
+            self.requests_remaining + self.max_requests_per_minute * elapsed / 60,
+        )
+        self.tokens_remaining = min(
+            self.max_tokens_per_minute,
+            self.tokens_remaining + self.max_tokens_per_minute * elapsed / 60,
+        )
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.requests_remaining >= 1 and self.tokens_remaining >= tokens:
+                    self.requests_remaining -= 1
+                    self.tokens_remaining -= tokens
+                    return
+                # Sleep just long enough for the scarcer bucket to refill
+                wait = max(
+                    (1 - self.requests_remaining) * 60 / self.max_requests_per_minute,
+                    (tokens - self.tokens_remaining) * 60 / self.max_tokens_per_minute,
+                )
+                await asyncio.sleep(wait)
+
+
+class SemanticIndex:
+    """Unit-length topic embeddings mapped to response cache keys."""
+
+    def __init__(self, cache, name, max_size=SEMANTIC_INDEX_SIZE):
+        self._cache = cache
+        self._name = name
+        self.max_size = max_size
+        self._lock = asyncio.Lock()
+        # Stored as (keys, float32 matrix); anything else is an older format
+        entries = cache.get(name)
+        if isinstance(entries, tuple):
+            self._keys, self._matrix = entries
+        else:
+            self._keys, self._matrix = [], None
+
+    async def lookup(self, embedding, threshold=SEMANTIC_THRESHOLD):
+        import numpy as np
+        match = None
+        pruned = False
+        while self._keys:
+            # Rows and query are normalized, so one mat-vec gives every cosine similarity
+            scores = self._matrix @ embedding
+            best = int(scores.argmax())
+            if scores[best] < threshold:
+                break
+            if self._keys[best] in self._cache:
+                match = self._keys[best]
+                break
+            # The response expired or was evicted; drop it and look again
+            # Rebind rather than mutate: a save may be pickling the old list in a thread
+            self._keys = self._keys[:best] + self._keys[best + 1:]
+            self._matrix = np.delete(self._matrix, best, axis=0) if self._keys else None
+            pruned = True
+        if pruned:
+            await self._save()
+        return match
+
+    async def add(self, key, embedding):
+        import numpy as np
+        if self._keys:
+            self._matrix = np.vstack([self._matrix, embedding])[-self.max_size:]
+        else:
+            self._matrix = embedding.reshape(1, -1)
+        self._keys = (self._keys + [key])[-self.max_size:]
+        await self._save()
+
+    async def _save(self):
+        # Pickling up to a few MB is slow, keep it off the event loop; the lock
+        # makes sure an older snapshot never overwrites a newer one
+        async with self._lock:
+            await asyncio.to_thread(self._cache.set, self._name, (self._keys, self._matrix))
+
+
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+_rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+_cache = diskcache.Cache(CACHE_DIR, eviction_policy="least-recently-used")
+
+# google-genai pulls in a large dependency tree, so import it on first use only.
+# The bot's post_init warm_up() imports it at startup anyway; the saving is for
+# code that imports this module without calling Gemini.
+@functools.lru_cache(maxsize=1)
+def _genai():
+    from google.genai import Client, errors, types
+    return SimpleNamespace(Client=Client, errors=errors, types=types)
+
+# Only built when the semantic cache is on, so numpy is never imported otherwise.
+# One index per prompt template, so batch and single posts never match each other.
+@functools.lru_cache(maxsize=None)
+def _semantic_index(template):
+    digest = hashlib.sha256(template.template.encode()).hexdigest()[:16]
+    return SemanticIndex(_cache, f"semantic_index:{digest}")
+
+@functools.lru_cache(maxsize=1)
+def _client():
+    CFG.require("gemini_api_key")
+    return _genai().Client(api_key=CFG.gemini_api_key)
+
+@functools.lru_cache(maxsize=1)
+def _generation_config():
+    return _genai().types.GenerateContentConfig(
+        temperature=TEMPERATURE, system_instruction=SYSTEM_PROMPT
     )
+
+@functools.lru_cache(maxsize=1)
+def _batch_generation_config():
+    return _genai().types.GenerateContentConfig(
+        temperature=TEMPERATURE,
+        system_instruction=SYSTEM_PROMPT,
+        response_mime_type="application/json",
+        response_schema=list[str],
+    )
+
+async def warm_up():
+    # Open the HTTPS connection to the Gemini API before the first real request
+    await _client().aio.models.get(model=MODEL)
+
+def _is_transient(exc):
+    # Retry rate limiting (429), server errors and timeouts; anything else is a real failure
+    errors = _genai().errors
+    if isinstance(exc, errors.ClientError):
+        return exc.code == 429
+    return isinstance(exc, (errors.ServerError, httpx.TimeoutException))
+
+_retry = retry(
+    retry=retry_if_exception(_is_transient),
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+
+@_retry
+async def _generate_content(prompt, config=None):
+    # Every attempt, retries included, goes through the rate limiter
+    await _rate_limiter.acquire(tokens=_estimate_tokens(prompt))
+    return await _client().aio.models.generate_content(
+        model=MODEL,
+        contents=prompt,
+        config=config or _generation_config(),
+    )
+
+async def _prepend(first, stream):
+    yield first
+    async for chunk in stream:
+        yield chunk
+
+@_retry
+async def _generate_content_stream(prompt):
+    await _rate_limiter.acquire(tokens=_estimate_tokens(prompt))
+    stream = await _client().aio.models.generate_content_stream(
+        model=MODEL,
+        contents=prompt,
+        config=_generation_config(),
+    )
+    # The stream is lazy: the request (and any 429/5xx) only happens on the
+    # first chunk, so pull it here where the retry can see the error
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        return stream
+    return _prepend(first, stream)
+
+async def _embed(topic):
+    try:
+        response = await _client().aio.models.embed_content(
+            model=EMBEDDING_MODEL, contents=topic
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ Embedding failed, skipping semantic cache: {e}")
+        return None
+    import numpy as np
+    vector = np.asarray(response.embeddings[0].values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def _normalize(topic):
+    return " ".join(topic.lower().split())
+
+def _cache_key(topic, template=PROMPT_TEMPLATE):
+    # The key covers every input of the prompt, so batch and single posts are cached apart
+    return hashlib.sha256(
+        f"{MODEL}|{TEMPERATURE}|{SYSTEM_PROMPT}|{template.template}|{topic}".encode()
+    ).hexdigest()
+
+def _estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN
+
+def _trim_topic(content):
+    """Cut pasted blobs down to the topic budget before they cost prompt tokens."""
+    limit = MAX_TOPIC_TOKENS * CHARS_PER_TOKEN
+    if len(content) <= limit:
+        return content
+    logger.info(f"✂️ Topic trimmed from {len(content)} to {limit} characters.")
+    return content[:limit]
+
+def _build_prompt(content):
+    return PROMPT_TEMPLATE.substitute(topic=content)
+
+async def _cache_lookup(content, template=PROMPT_TEMPLATE):
+    """Return (key, cached text or None, topic embedding or None)."""
+    topic = _normalize(content)
+    key = _cache_key(topic, template)
+    cached = _cache.get(key)
+    if cached is not None or not SEMANTIC_CACHE_ENABLED:
+        return key, cached, None
+
+    embedding = await _embed(topic)
+    if embedding is not None:
+        similar_key = await _semantic_index(template).lookup(embedding)
+        if similar_key:
+            cached = _cache.get(similar_key)
+    return key, cached, embedding
+
+async def _cache_store(key, text, embedding, template=PROMPT_TEMPLATE):
+    _cache.set(key, text, expire=CACHE_TTL)
+    if embedding is not None:
+        await _semantic_index(template).add(key, embedding)
+
+async def generate_post(content, use_cache=True):
+    content = _trim_topic(content)
+    prompt = _build_prompt(content)
+    use_cache = use_cache and CACHE_ENABLED
+    if use_cache:
+        key, cached, embedding = await _cache_lookup(content)
+        if cached is not None:
+            return cached
+
+    async with _semaphore:
+        # Use the async client so the bot's event loop keeps serving other updates
+        response = await _generate_content(prompt)
+    if use_cache and response.text:
+        await _cache_store(key, response.text, embedding)
     return response.text
 
+async def stream_post(content, use_cache=True, refresh=False):
+    """Yield the post text chunk by chunk as Gemini produces it.
+
+    refresh skips the cache lookup but still stores the new post, replacing
+    the cached one for this topic.
+    """
+    content = _trim_topic(content)
+    prompt = _build_prompt(content)
+    use_cache = use_cache and CACHE_ENABLED
+    if refresh:
+        key, embedding = _cache_key(_normalize(content)), None
+    elif use_cache:
+        key, cached, embedding = await _cache_lookup(content)
+        if cached is not None:
+            yield cached
+            return
+
+    text = ""
+    async with _semaphore:
+        stream = await _generate_content_stream(prompt)
+        async for chunk in stream:
+            if chunk.text:
+                text += chunk.text
+                yield chunk.text
+    if use_cache and text:
+        await _cache_store(key, text, embedding)
+
+async def generate_posts(topics):
+    """Generate one post per topic, sending all uncached topics in a single request.
+
+    Topics whose post failed or came back empty are returned as None.
+    """
+    topics = [_trim_topic(topic) for topic in topics]
+    posts = [None] * len(topics)
+    misses = []
+    for i, topic in enumerate(topics):
+        key, embedding = None, None
+        if CACHE_ENABLED:
+            key, posts[i], embedding = await _cache_lookup(topic, BATCH_PROMPT_TEMPLATE)
+        if posts[i] is None:
+            misses.append((i, key, embedding))
+    if not misses:
+        return posts
+
+    # One request for every miss: the system prompt is sent once and only one RPM slot is used
+    prompt = BATCH_PROMPT_TEMPLATE.substitute(
+        topics=json.dumps([topics[i] for i, _, _ in misses], ensure_ascii=False)
+    )
+    generated = None
+    try:
+        async with _semaphore:
+            response = await _generate_content(prompt, _batch_generation_config())
+        generated = response.parsed
+    except Exception as e:
+        logger.error(f"❌ Batch request failed: {e}")
+    template = BATCH_PROMPT_TEMPLATE
+    if not isinstance(generated, list) or len(generated) != len(misses):
+        logger.warning("⚠️ No usable batch response, generating one by one.")
+        # One failing topic must not take the others down with it
+        generated = await asyncio.gather(
+            *(generate_post(topics[i], use_cache=False) for i, _, _ in misses),
+            return_exceptions=True,
+        )
+        # These came from PROMPT_TEMPLATE, so cache them under its key
+        template = PROMPT_TEMPLATE
+        misses = [
+            (i, _cache_key(_normalize(topics[i])), embedding)
+            for i, _, embedding in misses
+        ]
+
+    for (i, key, embedding), text in zip(misses, generated):
+        if isinstance(text, Exception):
+            logger.error(f"❌ Failed to generate a post for {topics[i]!r}: {text}")
+            continue
+        if not text:
+            continue
+        posts[i] = text
+        if CACHE_ENABLED:
+            await _cache_store(key, text, embedding, template)
+    return posts
@@ -1,47 +1,95 @@
+import asyncio
 import os
-import requests
+import httpx
+from tenacity import (
+    retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+)
+from utils.config import CFG
+from utils.logger import setup_logger
 
-def post_to_linkedin(text, image_path=None):
-    url = "https://hook.eu2.make.com/d6eank315humfn1i9ml9v4nd4qj7pp6k"
+logger = setup_logger("LinkedIn")
 
-    files = {}
+MAKE_WEBHOOK_URL = CFG.make_webhook_url
+
+# Cap simultaneous uploads so a burst of approvals doesn't trip the webhook's rate limit
+MAX_CONCURRENT_POSTS = CFG.linkedin_max_concurrent_posts
+_semaphore = asyncio.Semaphore(MAX_CONCURRENT_POSTS)
+
+# One pooled HTTP/2 client for every post, so DNS + TLS setup is paid once
+_client = httpx.AsyncClient(
+    # retries= only re-attempts failed connects, which is always safe for a POST
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        # Posts are minutes apart, keep the connection around longer than httpx's 5s default
+        limits=httpx.Limits(max_connections=50, keepalive_expiry=75),
+    ),
+    timeout=30,
+)
+
+# Statuses where the webhook did not accept the post, so sending it again can't duplicate it.
+# 502/504 are left out: a gateway error can arrive after Make.com already ran the scenario.
+RETRY_STATUSES = {429, 503}
+
+def _is_retryable(exc):
+    return (
+        isinstance(exc, httpx.HTTPStatusError)
+        and exc.response.status_code in RETRY_STATUSES
+    )
+
+_backoff = wait_random_exponential(multiplier=1, max=30)
+
+def _retry_wait(retry_state):
+    # Honour the webhook's Retry-After, otherwise jittered exponential backoff capped at 30s
+    retry_after = retry_state.outcome.exception().response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(float(retry_after), 30)
+    return _backoff(retry_state)
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    stop=stop_after_attempt(3),
+    wait=_retry_wait,
+    reraise=True,
+)
+async def _send(url, data, files):
+    async with _semaphore:
+        response = await _client.post(url, data=data, files=files)
+    response.raise_for_status()
+    return response
+
+async def post_to_linkedin(text, image_bytes=None, filename="image.jpg"):
+    files = None
     data = {"text": text}
 
-    if image_path:
+    if image_bytes:
         # Get file extension and determine content type
-        ext = os.path.splitext(image_path)[1].lower()
+        ext = os.path.splitext(filename)[1].lower()
         content_type = "image/png" if ext == ".png" else "image/jpeg"
-        
-        try:
-            # Use a context manager to ensure the file is properly closed
-            with open(image_path, 'rb') as img_file:
-                files['image'] = (os.path.basename(image_path), img_file, content_type)
-                response = requests.post(url, data=data, files=files)
-                response.raise_for_status()
-                print("✅ Sent to Make.com with image successfully.")
-                return response.status_code, response.text
-        except FileNotFoundError:
-            print(f"❌ Error: Image file not found at {image_path}")
-            return 404, "Image file not found"
-        except Exception as e:
-            print(f"❌ Error sending to Make.com: {e}")
-            return 500, str(e)
-    else:
-        try:
-            response = requests.post(url, data=data)
-            response.raise_for_status()
-            print("✅ Sent to Make.com successfully.")
-            return response.status_code, response.text
-        except Exception as e:
-            print(f"❌ Error sending to Make.com: {e}")
-            return 500, str(e)
+        # The image is uploaded straight from memory, it never touches disk
+        files = {'image': (filename, image_bytes, content_type)}
+
+    try:
+        response = await _send(MAKE_WEBHOOK_URL, data, files)
+        if files:
+            logger.info("✅ Sent to Make.com with image successfully.")
+        else:
+            logger.info("✅ Sent to Make.com successfully.")
+        return response.status_code, response.text
+    except Exception as e:
+        logger.error(f"❌ Error sending to Make.com: {e}", exc_info=True)
+        return 500, str(e)
+
+async def close():
+    await _client.aclose()
 
 # Example usage
 if __name__ == "__main__":
     # Test with just text
-    status, response = post_to_linkedin("Test post")
+    status, response = asyncio.run(post_to_linkedin("Test post"))
     print(f"Status: {status}, Response: {response}")
     
     # Test with an image (uncomment and replace with actual path)
-    # status, response = post_to_linkedin("Test post with image", "/path/to/your/image.jpg")
+    # with open("/path/to/your/image.jpg", "rb") as f:
+    #     status, response = asyncio.run(post_to_linkedin("Test post with image", f.read(), "image.jpg"))
     # print(f"Status: {status}, Response: {response}")
@@ -0,0 +1,70 @@
+# utils/config.py
+import os
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Settings read from the environment (and .env) once at startup."""
+
+    telegram_token: str | None
+    authorized_user_id: int | None
+    gemini_api_key: str | None
+    bot_state_file: str
+    webhook_url: str | None
+    webhook_port: int
+    webhook_secret: str | None
+    redis_url: str | None
+    make_webhook_url: str
+    linkedin_max_concurrent_posts: int
+    gemini_temperature: float
+    gemini_cache_dir: str
+    gemini_cache_ttl: int
+    gemini_cache_enabled: bool
+    gemini_semantic_cache: bool
+    gemini_semantic_threshold: float
+    gemini_max_concurrency: int
+    gemini_max_rpm: int
+    gemini_max_tpm: int
+
+    @classmethod
+    def from_env(cls):
+        load_dotenv()
+        env = os.environ
+        user_id = env.get("AUTHORIZED_USER_ID")
+        return cls(
+            telegram_token=env.get("TELEGRAM_TOKEN") or None,
+            authorized_user_id=int(user_id) if user_id else None,
+            gemini_api_key=env.get("GEMINI_API_KEY") or None,
+            bot_state_file=env.get("BOT_STATE_FILE", "bot_state.pkl"),
+            # Set WEBHOOK_URL to receive updates via webhook instead of long polling
+            webhook_url=env.get("WEBHOOK_URL"),
+            # PORT is what most hosting platforms inject
+            webhook_port=int(env.get("WEBHOOK_PORT") or env.get("PORT") or "8443"),
+            webhook_secret=env.get("WEBHOOK_SECRET"),
+            redis_url=env.get("REDIS_URL"),
+            make_webhook_url=env.get(
+                "MAKE_WEBHOOK_URL", "https://hook.eu2.make.com/d6eank315humfn1i9ml9v4nd4qj7pp6k"
+            ),
+            linkedin_max_concurrent_posts=int(env.get("LINKEDIN_MAX_CONCURRENT_POSTS", "10")),
+            gemini_temperature=float(env.get("GEMINI_TEMPERATURE", "1.0")),
+            gemini_cache_dir=env.get("GEMINI_CACHE_DIR", "/tmp/ai_cache"),
+            gemini_cache_ttl=int(env.get("GEMINI_CACHE_TTL", str(7 * 86400))),
+            # Set GEMINI_NO_CACHE=1 to always hit the API
+            gemini_cache_enabled=env.get("GEMINI_NO_CACHE") != "1",
+            gemini_semantic_cache=env.get("GEMINI_SEMANTIC_CACHE") == "1",
+            gemini_semantic_threshold=float(env.get("GEMINI_SEMANTIC_THRESHOLD", "0.92")),
+            gemini_max_concurrency=int(env.get("GEMINI_MAX_CONCURRENCY", "4")),
+            gemini_max_rpm=int(env.get("GEMINI_MAX_RPM", "10")),
+            gemini_max_tpm=int(env.get("GEMINI_MAX_TPM", "250000")),
+        )
+
+    def require(self, *fields):
+        """Fail fast when settings a caller depends on are missing."""
+        missing = [field.upper() for field in fields if getattr(self, field) is None]
+        if missing:
+            raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+
+CFG = Config.from_env()
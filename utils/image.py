@@ -0,0 +1,23 @@
+# utils/image.py
+from io import BytesIO
+from PIL import Image
+
+# LinkedIn renders feed images at most 1200px wide
+MAX_IMAGE_SIZE = (1200, 1200)
+JPEG_QUALITY = 85
+
+
+def shrink_image(image_bytes, max_size=MAX_IMAGE_SIZE, quality=JPEG_QUALITY):
+    """Downscale an image to fit max_size and re-encode it as progressive JPEG.
+
+    Images that already fit are returned unchanged.
+    """
+    with Image.open(BytesIO(image_bytes)) as img:
+        if img.width <= max_size[0] and img.height <= max_size[1]:
+            return image_bytes
+        img.thumbnail(max_size, Image.LANCZOS)
+        out = BytesIO()
+        img.convert("RGB").save(
+            out, "JPEG", quality=quality, progressive=True, optimize=True
+        )
+        return out.getvalue()
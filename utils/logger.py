@@ -1,11 +1,34 @@
 # utils/logger.py
+import atexit
 import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+_lock = threading.Lock()
+_queue_handler = None
+
+def _get_queue_handler():
+    # Loggers only enqueue records; one background thread writes them to stderr
+    global _queue_handler
+    if _queue_handler is None:
+        log_queue = queue.SimpleQueue()
+        handler = logging.StreamHandler()
+        formatter = logging.Formatter('[%(levelname)s] %(message)s')
+        handler.setFormatter(formatter)
+        listener = QueueListener(log_queue, handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        _queue_handler = QueueHandler(log_queue)
+    return _queue_handler
 
 def setup_logger(name):
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter('[%(levelname)s] %(message)s')
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    with _lock:
+        # Calling setup_logger twice for the same name must not duplicate output
+        if logger.handlers:
+            return logger
+        logger.setLevel(logging.INFO)
+        logger.addHandler(_get_queue_handler())
+        logger.propagate = False
     return logger
@@ -0,0 +1,90 @@
+# utils/state.py
+import time
+import redis.asyncio as redis
+from utils.config import CFG
+
+# Abandoned conversations expire after an hour
+STATE_TTL = 3600
+
+
+class UserDataStore:
+    """Per-user conversation state kept in the application's user_data.
+
+    The application's persistence (PicklePersistence in bot.py) saves it,
+    so drafts survive a restart; clear() drops the entry entirely and
+    expire() drops drafts untouched for longer than the TTL.
+    """
+
+    def __init__(self, application, ttl=STATE_TTL):
+        self.application = application
+        self.ttl = ttl
+
+    async def get(self, user_id):
+        return dict(self.application.user_data.get(user_id, {}))
+
+    async def set(self, user_id, **fields):
+        data = self.application.user_data[user_id]
+        data.clear()
+        data.update(fields, updated_at=time.time())
+
+    async def update(self, user_id, **fields):
+        self.application.user_data[user_id].update(fields, updated_at=time.time())
+
+    async def clear(self, user_id):
+        self.application.drop_user_data(user_id)
+
+    async def expire(self):
+        cutoff = time.time() - self.ttl
+        stale = [
+            user_id for user_id, data in self.application.user_data.items()
+            if data.get("updated_at", 0) < cutoff
+        ]
+        for user_id in stale:
+            self.application.drop_user_data(user_id)
+
+
+class RedisStore:
+    """Per-user drafts kept in Redis, expired server-side after the TTL.
+
+    Only the draft lives here; the ConversationHandler step stays in the
+    process (and its pickle), so this is not a way to run several bot
+    workers side by side.
+    """
+
+    def __init__(self, url, ttl=STATE_TTL):
+        self.redis = redis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+
+    def _key(self, user_id):
+        return f"bot:user:{user_id}"
+
+    async def get(self, user_id):
+        return await self.redis.hgetall(self._key(user_id))
+
+    async def set(self, user_id, **fields):
+        key = self._key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def update(self, user_id, **fields):
+        key = self._key(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping=fields)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def clear(self, user_id):
+        await self.redis.delete(self._key(user_id))
+
+    async def expire(self):
+        # Redis drops idle keys itself via EXPIRE
+        pass
+
+
+def create_store(application):
+    if CFG.redis_url:
+        return RedisStore(CFG.redis_url)
+    return UserDataStore(application)